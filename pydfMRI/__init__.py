@@ -1 +1 @@
- 
+from pydfMRI.memory import set_memory_budget, get_memory_budget, plan_memory
@@ -0,0 +1,154 @@
+import os
+import glob
+import hashlib
+import json
+import sqlite3
+import numpy as np
+import nibabel as nib
+from pydfMRI.handle_nifti import nifti_fields, load_affine
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS nifti (
+                 path TEXT PRIMARY KEY,
+                 mtime REAL,
+                 size INTEGER,
+                 ndim INTEGER,
+                 shape TEXT,
+                 TR REAL,
+                 datatype INTEGER,
+                 affine TEXT,
+                 header TEXT)"""
+
+
+def _header_row(path: str, stat: os.stat_result) -> tuple:
+    """ Parse the header only (the data is never read) and return the row to store """
+    img = nib.load(path)
+    hdr = img.header
+    fields = {}
+    for k in nifti_fields():
+        if k in hdr:
+            value = hdr[k].tolist()
+            fields[k] = value.decode(errors='replace') if isinstance(value, bytes) else value
+    # TR in seconds, the raw pixdim stays in the header fields
+    time_scale = {'msec': 1e-3, 'usec': 1e-6}.get(hdr.get_xyzt_units()[1], 1.0)
+    return (path, stat.st_mtime, stat.st_size, len(img.shape), json.dumps([int(s) for s in img.shape]),
+            float(hdr['pixdim'][4]) * time_scale, int(hdr['datatype']), json.dumps(img.affine.tolist()),
+            json.dumps(fields))
+
+
+def _default_db_name(root: str) -> str:
+    """ Index file in the user cache, one per dataset root, so that the dataset is never written to """
+    cache = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'pydfMRI')
+    os.makedirs(cache, exist_ok=True)
+    digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(cache, f'index_{digest}.sqlite')
+
+
+def index_dataset(root: str, db_name: str = None, patterns: tuple = ('*.nii', '*.nii.gz')) -> str:
+    """
+    Function that scans a dataset once and stores the header of every NIfTI file (shape, TR in
+    seconds according to xyzt_units, affine, datatype and the fields of nifti_fields) in a SQLite
+    index. Rescanning only parses the files whose mtime or size changed, and drops the files that
+    were removed
+    Usage: index then list all 4D ADC runs with TR=1s
+        db = index_dataset('/path/to/dataset')
+        runs = query_index(db, name='*adc*', ndim=4, TR=1)
+
+    Args:
+        root (str): directory of the dataset, searched recursively
+        db_name (str): filename of the index. Default None -> a file of $XDG_CACHE_HOME/pydfMRI
+                       (~/.cache/pydfMRI) named after root, the dataset itself is never written to
+        patterns (tuple): glob patterns of the files to index
+
+    Returns:
+        db_name (str): filename of the index
+
+    """
+
+    if db_name is None:
+        db_name = _default_db_name(root)
+
+    paths = set()
+    for pattern in patterns:
+        paths.update(os.path.abspath(p) for p in glob.glob(os.path.join(root, '**', pattern), recursive=True))
+
+    with sqlite3.connect(db_name) as db:
+        db.execute(_SCHEMA)
+        known = {p: (m, s) for p, m, s in db.execute('SELECT path, mtime, size FROM nifti')}
+        root_prefix = os.path.join(os.path.abspath(root), '')
+        removed = [(p,) for p in known if p.startswith(root_prefix) and p not in paths]
+        db.executemany('DELETE FROM nifti WHERE path = ?', removed)
+
+        rows = []
+        for path in sorted(paths):
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+            try:
+                rows.append(_header_row(path, stat))
+            except nib.filebasedimages.ImageFileError:
+                continue  # not a readable nifti, skip it
+        db.executemany('INSERT OR REPLACE INTO nifti VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    db.close()
+
+    return db_name
+
+
+def query_index(db_name: str, name: str = None, ndim: int = None, shape: tuple = None, TR: float = None,
+                datatype: int = None, affine=None, atol: float = 1e-4) -> list:
+    """
+    Function that selects files from an index built by index_dataset, without opening them
+    Usage: all 4D ADC runs with TR=1s sharing the affine of a reference run
+        query_index(db, name='*adc*', ndim=4, TR=1, affine='/path/to/ref_adc.nii.gz')
+
+    Args:
+        db_name (str): filename of the index
+        name (str): glob pattern matched against the full path, e.g. '*adc*'
+        ndim (int): number of dimensions
+        shape (tuple): exact shape
+        TR (float): repetition time [s] (pixdim[4] converted with xyzt_units), matched up to atol
+        datatype (int): NIfTI datatype code
+        affine (np.ndarray, str): 4x4 affine, or path of an indexed file whose affine is used,
+                                  matched up to atol
+        atol (float): absolute tolerance for TR and affine
+
+    Returns:
+        (list): dicts with 'path', 'shape', 'TR', 'datatype', 'affine' (np.ndarray) and 'header',
+                sorted by path
+
+    """
+
+    conditions, params = [], []
+    if name is not None:
+        conditions.append('path GLOB ?')
+        params.append(name)
+    if ndim is not None:
+        conditions.append('ndim = ?')
+        params.append(int(ndim))
+    if shape is not None:
+        conditions.append('shape = ?')
+        params.append(json.dumps([int(s) for s in shape]))
+    if TR is not None:
+        conditions.append('ABS(TR - ?) <= ?')
+        params += [float(TR), atol]
+    if datatype is not None:
+        conditions.append('datatype = ?')
+        params.append(int(datatype))
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    with sqlite3.connect(db_name) as db:
+        if isinstance(affine, str):
+            ref = db.execute('SELECT affine FROM nifti WHERE path = ?', (os.path.abspath(affine),)).fetchone()
+            affine = json.loads(ref[0]) if ref is not None else load_affine(affine)
+        rows = db.execute(f'SELECT path, shape, TR, datatype, affine, header FROM nifti{where} ORDER BY path',
+                          params).fetchall()
+    db.close()
+
+    matches = []
+    for path, shp, tr, dtype, aff, hdr in rows:
+        aff = np.array(json.loads(aff))
+        if affine is not None and not np.allclose(aff, affine, atol=atol):
+            continue
+        matches.append({'path': path, 'shape': tuple(json.loads(shp)), 'TR': tr, 'datatype': dtype,
+                        'affine': aff, 'header': json.loads(hdr)})
+    return matches
+
@@ -0,0 +1,191 @@
+import numpy as np
+import nibabel as nib
+import scipy.stats as st
+from scipy import special
+from pydfMRI.handle_nifti import save_nifti
+
+
+def canonical_hrf(TR: float, length: float = 32.0) -> np.ndarray:
+    """
+    Function that samples the SPM canonical (double gamma) haemodynamic response function
+
+    Args:
+        TR (float): repetition time [s]
+        length (float): duration of the kernel [s]
+
+    Returns:
+        hrf (np.ndarray): kernel sampled every TR, normalized to unit sum
+
+    Raises:
+        ValueError: if TR <= 0
+
+    """
+
+    if not TR > 0:
+        raise ValueError(f"The TR must be positive to sample the HRF, got {TR} (pixdim[4] unset?)")
+    t = np.arange(0, length, TR)
+    hrf = st.gamma.pdf(t, 6) - st.gamma.pdf(t, 16) / 6
+    return hrf / np.sum(hrf)
+
+
+def block_design(n_timepoints: int, epoch_length: int = 15, stim_length: int = 6, TR: float = 2.0,
+                 offset: int = None, hrf: bool = True, drift_order: int = 1) -> np.ndarray:
+    """
+    Function that builds the design matrix of a block paradigm: back-to-back epochs of
+    epoch_length samples, the stimulus being on for the first stim_length samples of each epoch
+    (see plot_timeserie_byepoch).
+
+    Args:
+        n_timepoints (int): number of volumes of the timeserie
+        epoch_length (int): duration of "1 epoch in [s] divided by TR"
+        stim_length (int): duration of "stimulus on in [s] divided by TR"
+        TR (float): repetition time [s], used for the HRF convolution
+        offset (int): index of the first epoch onset. Default None -> n_timepoints % epoch_length,
+                      i.e. the first rest values are discarded as in reshape_timeseries_byepoch
+        hrf (bool): convolve the stimulus boxcar with the canonical HRF
+        drift_order (int): order of the Legendre polynomial drift regressors (0 -> constant only)
+
+    Returns:
+        design (np.ndarray): (n_timepoints x (2 + drift_order)), column 0 is the stimulus
+                             regressor, column 1 the constant
+
+    """
+
+    if offset is None:
+        offset = n_timepoints % epoch_length
+
+    boxcar = np.zeros(n_timepoints)
+    within_epoch = (np.arange(n_timepoints) - offset) % epoch_length
+    boxcar[(np.arange(n_timepoints) >= offset) & (within_epoch < stim_length)] = 1
+    if hrf:
+        boxcar = np.convolve(boxcar, canonical_hrf(TR))[:n_timepoints]
+
+    x = np.linspace(-1, 1, n_timepoints)
+    drifts = np.polynomial.legendre.legvander(x, drift_order)  # first column is the constant
+
+    return np.column_stack([boxcar - boxcar.mean(), drifts])
+
+
+def fit_glm(timecourses: np.ndarray, design: np.ndarray, contrast: np.ndarray = None) -> dict:
+    """
+    Function that fits the same GLM to many timecourses at once with ordinary least squares
+
+    Args:
+        timecourses (np.ndarray): (number_of_voxels x n_timepoints)
+        design (np.ndarray): (n_timepoints x n_regressors) design matrix
+        contrast (np.ndarray): (n_regressors,) t contrast. Default None -> [1, 0, ..., 0]
+
+    Returns:
+        (dict): 'beta' (number_of_voxels x n_regressors), 't', 'F', 'z' (number_of_voxels,) and
+                'df' the residual degrees of freedom. z is the F to z conversion, as in SPM
+
+    Raises:
+        ValueError: if the design leaves no residual degrees of freedom
+
+    """
+
+    if contrast is None:
+        contrast = np.zeros(design.shape[1])
+        contrast[0] = 1
+    contrast = np.asarray(contrast, dtype=float)
+
+    pinv = np.linalg.pinv(design)
+    df = design.shape[0] - np.linalg.matrix_rank(design)
+    if df <= 0:
+        raise ValueError(f"The design leaves {df} residual degrees of freedom, more timepoints are needed!")
+    c_var = contrast @ pinv @ pinv.T @ contrast
+
+    beta = timecourses @ pinv.T
+    residuals = timecourses - beta @ design.T
+    sigma2 = np.einsum('ij,ij->i', residuals, residuals) / df
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (beta @ contrast) / np.sqrt(sigma2 * c_var)
+    t = np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+    F = t ** 2
+    # Conversion in log space, the p-value of strong effects underflows
+    log_p = st.f.logsf(F, 1, df)
+    tail = ~np.isfinite(log_p)
+    if np.any(tail):
+        # Leading term of the incomplete beta, sf = I_x(df/2, 1/2) with x = df/(df+F) -> 0
+        x = df / (df + F[tail])
+        log_p[tail] = (df / 2 * np.log(x) + 0.5 * np.log1p(-x) - np.log(df / 2)
+                       - special.betaln(df / 2, 0.5))
+    z = -special.ndtri_exp(log_p)
+    z[F == 0] = 0  # degenerate (constant) timecourses
+
+    return {'beta': beta, 't': t, 'F': F, 'z': z, 'df': df}
+
+
+def glm_block(adc_filename: str, out_prefix: str = None, mask_name: str = None, mask_idx: list = None,
+              epoch_length: int = 15, stim_length: int = 6, TR: float = None, offset: int = None,
+              hrf: bool = True, drift_order: int = 1, chunk_size: int = 20000) -> dict:
+    """
+    Function that runs a mass-univariate block design GLM on an ADC timeserie and returns the
+    t, F and F to z statistical maps (the latter can be fed to find_significant_vx)
+
+    Args:
+        adc_filename (str): filename where adc.nii.gz is stored
+        out_prefix (str): if given, save '{out_prefix}_tmap.nii.gz', '_Fmap' and '_zfmap' with the
+                          affine of adc_filename. Default None -> return the maps as arrays
+        mask_name (str): optional mask, only in-mask voxels are fitted. Default None -> voxels
+                         with a non-zero timeserie
+        mask_idx (list): mask indices of interest. Default None -> any non-zero label
+        epoch_length (int): duration of "1 epoch in [s] divided by TR"
+        stim_length (int): duration of "stimulus on in [s] divided by TR"
+        TR (float): repetition time [s]. Default None -> pixdim[4] of the header, converted to
+                    seconds with xyzt_units
+        offset (int): see block_design
+        hrf (bool): see block_design
+        drift_order (int): see block_design
+        chunk_size (int): number of voxels fitted at once, bounds the memory used
+
+    Returns:
+        (dict): {'t', 'F', 'z'} -> 3D np.ndarray, or path of the saved maps if out_prefix is given
+
+    Raises:
+        ValueError: if the mask shape does not match the ADC volume, or if the TR is not positive
+                    while hrf is True
+
+    """
+
+    img = nib.load(adc_filename)
+    adc = np.asarray(img.dataobj, dtype=np.float32)
+    if TR is None:
+        # pixdim[4] in seconds according to xyzt_units
+        time_scale = {'msec': 1e-3, 'usec': 1e-6}.get(img.header.get_xyzt_units()[1], 1.0)
+        TR = float(img.header['pixdim'][4]) * time_scale
+
+    if mask_name is None:
+        # Volume by volume, to avoid a full 4D boolean array
+        mask = np.zeros(adc.shape[:3], dtype=bool)
+        for t in range(adc.shape[3]):
+            mask |= adc[..., t] != 0
+    else:
+        mask = nib.load(mask_name).get_fdata()
+        if mask.shape != adc.shape[:3]:
+            raise ValueError(f"Mask shape {mask.shape} does not match the ADC shape {adc.shape[:3]}!")
+        mask = np.isin(mask, mask_idx) if mask_idx is not None else mask != 0
+    voxels = np.flatnonzero(mask)
+
+    design = block_design(adc.shape[3], epoch_length, stim_length, TR, offset, hrf, drift_order)
+
+    maps = {k: np.zeros(mask.size, dtype=np.float32) for k in ('t', 'F', 'z')}
+    for start in range(0, len(voxels), chunk_size):
+        chunk = voxels[start:start + chunk_size]
+        # Gather only the voxels of the chunk, reshaping the F-ordered volume would copy it
+        fit = fit_glm(adc[np.unravel_index(chunk, mask.shape)].astype(np.float64), design)
+        for k in maps:
+            maps[k][chunk] = fit[k]
+    del adc
+
+    maps = {k: v.reshape(mask.shape) for k, v in maps.items()}
+    if out_prefix is None:
+        return maps
+
+    names = {'t': 'tmap', 'F': 'Fmap', 'z': 'zfmap'}
+    paths = {}
+    for k, v in maps.items():
+        paths[k] = f'{out_prefix}_{names[k]}.nii.gz'
+        save_nifti(v, paths[k], img.affine)
+    return paths
@@ -2,6 +2,8 @@ import numpy as np
 import nibabel as nib
 import itertools as itt
 import os
+import warnings
+from pydfMRI.memory import plan_memory, iter_chunks, allocate_output
 
 
 def save_nifti(input_img: np.ndarray, save_name: str, affine_transf: np.ndarray = np.eye(4),
@@ -40,7 +42,7 @@ def load_affine(img_path: str) -> np.ndarray:
     return img.affine
 
 
-def quicknii(inimg, func, outimg="/path/newimg.nii.gz", *args, **kwargs):
+def quicknii(inimg, func, outimg="/path/newimg.nii.gz", *args, elementwise=False, plan=None, **kwargs):
     """
     "That's pure magic!" - Everyone using this function.
     Usage: power 2 of img.nii and save with newname
@@ -54,6 +56,12 @@ def quicknii(inimg, func, outimg="/path/newimg.nii.gz", *args, **kwargs):
                 <None> -> OVERWRITE computation to inimg
                 <False> -> return np.array
         *args,**kwargs : additional arguments for the input function
+        elementwise : <bool>, func works value by value (np.power, np.log, ...). If the image does
+                      not fit in the memory budget (see pydfMRI.memory) it is then processed by
+                      chunks of volumes instead of as a single float64 array, the output being
+                      backed by a temporary file if it does not fit either. Otherwise a warning
+                      is raised and the image is loaded whole. [default=False]
+        plan : <dict>, execution plan from plan_memory. [default=None -> planned from the header]
 
     Return:
           see outimg parameter description
@@ -66,8 +74,23 @@ def quicknii(inimg, func, outimg="/path/newimg.nii.gz", *args, **kwargs):
         img = nib.load(inimg)
 
     aff, hdr = img.affine, img.header
-    newimg = nib.Nifti1Image(func(img.get_fdata(), *args, **kwargs),
-                             affine=aff, header=hdr)
+    if plan is None:
+        plan = plan_memory(img, n_copies=2)  # input + func output
+    if elementwise and plan['mode'] == 'chunked':
+        newdata = None
+        for sl, chunk in iter_chunks(img, plan):
+            out = func(chunk, *args, **kwargs)
+            if newdata is None:  # in memory if it fits, else memmap
+                newdata = allocate_output(plan['shape'], out.dtype, plan)
+            index = [slice(None)] * len(plan['shape'])
+            index[plan['chunk_axis']] = sl
+            newdata[tuple(index)] = out
+    else:
+        if plan['mode'] == 'chunked':
+            warnings.warn(f'{getattr(func, "__name__", func)} is not declared elementwise, the whole image is loaded '
+                          f'although it needs ~{plan["peak"] / 1024 ** 2:.1f} MiB, more than the memory budget')
+        newdata = func(img.get_fdata(), *args, **kwargs)
+    newimg = nib.Nifti1Image(newdata, affine=aff, header=hdr)
     if outimg is None:
         nib.save(newimg, inimg)  # overwrite input img
         return inimg
@@ -1,5 +1,7 @@
+import csv
 import numpy as np
 import nibabel as nib
+from pydfMRI.memory import plan_memory, iter_chunks
 
 def calculate_temporal_mean(input_img: np.ndarray) -> float:
     """
@@ -75,14 +77,16 @@ def find_significant_vx(mask_name: str, mask_idx: list, zfmap_name: str, thresh:
     
     return  significant_vx
 
-def load_timecourses(adc_filename: str, significant_vx: np.ndarray) -> np.ndarray:
+def load_timecourses(adc_filename: str, significant_vx: np.ndarray, plan: dict = None) -> np.ndarray:
     """
-    Function that loads the ADC timeseries of the significant voxels
+    Function that loads the ADC timeseries of the significant voxels. If the image does not fit
+    in the memory budget (see pydfMRI.memory), it is read by chunks of volumes
    
     Args:
         adc_filename (str) : filename where adc.nii.gz is stored
         significant_vx (np.ndarray) : array containing the x,y,z indices of the 
                                       significant ADC voxels
+        plan (dict) : execution plan from plan_memory. Default None -> planned from the header
    
     Returns:
         (np.ndarray) : (len(significant_vx) x adc.shape[3])
@@ -90,16 +94,93 @@ def load_timecourses(adc_filename: str, significant_vx: np.ndarray) -> np.ndarra
     """
 
     adc = nib.load(adc_filename)
-    adc = adc.get_fdata()
-    adc_timecourses = np.zeros((len(significant_vx), adc.shape[3]))
+    if plan is None:
+        plan = plan_memory(adc)
+    significant_vx = tuple(np.asarray(significant_vx, dtype=int).reshape(-1, 3).T)
+    adc_timecourses = np.zeros((len(significant_vx[0]), adc.shape[3]))
 
-    for i in range(len(significant_vx)):
-        adc_timecourses[i, :] = adc[significant_vx[i][0], significant_vx[i][1], significant_vx[i][2], :]
+    if plan['mode'] == 'memory':
+        adc_timecourses[:] = adc.get_fdata()[significant_vx]
+    else:
+        for sl, chunk in iter_chunks(adc, plan):
+            adc_timecourses[:, sl] = chunk[significant_vx]
 
     del adc
 
     return adc_timecourses
 
+def extract_roi_timecourses(adc_filename: str, atlas_name: str, labels: list = None, zfmap_name: str = None,
+                            thresh: float = 3.1, statistic: tuple = ("mean", "median")) -> dict:
+    """
+    Function that extracts the ADC timecourses of many atlas labels in a single pass over
+    the 4D data, instead of calling find_significant_vx and load_timecourses per label
+    
+    Args:
+        adc_filename (str) : filename where adc.nii.gz is stored
+        atlas_name (str) : name of the atlas, in the space of adc_filename
+        labels (list) : atlas labels of interest. Default None -> all non-zero labels
+                        (returned sorted)
+        zfmap_name (str) : optional F to z statistical map, only voxels above thresh are kept
+        thresh (float) : threshold for significance, used with zfmap_name
+        statistic (tuple, str) : reductions to compute, "mean" and/or "median"
+    
+    Returns:
+        (dict) : 'labels' (number_of_labels,), 'counts' (number_of_labels,) the number of voxels
+                 of each label and one (number_of_labels x adc.shape[3]) array per statistic.
+                 Labels without any voxel get a NaN timecourse
+    
+    Raises:
+        ValueError : if the atlas or the z-map shape does not match the ADC volume
+    
+    """
+
+    statistic = (statistic,) if isinstance(statistic, str) else statistic
+    adc = nib.load(adc_filename)
+    # Round rather than truncate, resampled or float atlases hold values such as 2.9999999
+    atlas = np.rint(np.asarray(nib.load(atlas_name).dataobj)).astype(np.int64)
+    if atlas.shape != adc.shape[:3]:
+        raise ValueError(f"Atlas shape {atlas.shape} does not match the ADC shape {adc.shape[:3]}!")
+    atlas = atlas.ravel()
+    if labels is None:
+        labels = np.unique(atlas[atlas != 0])
+    labels = np.unique(np.asarray(labels, dtype=np.int64))
+
+    keep = np.isin(atlas, labels)
+    if zfmap_name is not None:
+        zscore = nib.load(zfmap_name)
+        if zscore.shape[:3] != adc.shape[:3]:
+            raise ValueError(f"Z-map shape {zscore.shape} does not match the ADC shape {adc.shape[:3]}!")
+        keep &= zscore.get_fdata().ravel() > thresh
+    voxels = np.flatnonzero(keep)
+    # Order the voxels by label so that every label is a contiguous segment
+    rank = np.searchsorted(labels, atlas[voxels])
+    order = np.argsort(rank, kind="stable")
+    voxels, rank = voxels[order], rank[order]
+
+    adc = np.asarray(adc.dataobj, dtype=np.float32)
+    # Gather only the atlas voxels, reshaping the F-ordered volume would copy it
+    timecourses = adc[np.unravel_index(voxels, adc.shape[:3])]
+    del adc
+
+    counts = np.bincount(rank, minlength=len(labels))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    present = counts > 0
+
+    out = {"labels": labels, "counts": counts}
+    if "mean" in statistic:
+        mean = np.full((len(labels), timecourses.shape[1]), np.nan)
+        if np.any(present):
+            sums = np.add.reduceat(timecourses, starts[present], axis=0, dtype=np.float64)
+            mean[present] = sums / counts[present, None]
+        out["mean"] = mean
+    if "median" in statistic:
+        median = np.full((len(labels), timecourses.shape[1]), np.nan)
+        for i in np.flatnonzero(present):
+            median[i] = np.median(timecourses[starts[i]:starts[i] + counts[i]], axis=0)
+        out["median"] = median
+
+    return out
+
 def reshape_timeseries_byepoch(timeserie: np.ndarray, epoch_length: int=15) -> np.ndarray:
     """
     Function that reshape a timeserie from [epoch1, epoch2, ..., epochn] to 
@@ -124,10 +205,95 @@ def reshape_timeseries_byepoch(timeserie: np.ndarray, epoch_length: int=15) -> n
 
     return adc_timecourse.reshape((-1, epoch_length))
 
+def load_events(events_name: str, trial_type: str = None) -> tuple:
+    """
+    Function that reads an events table with "onset" and "duration" columns (BIDS events.tsv,
+    or .csv), in seconds
+    
+    Args:
+        events_name (str) : filename of the events table
+        trial_type (str) : keep only the events of this trial_type. Default None -> all events
+    
+    Returns:
+        onsets, durations (np.ndarray, np.ndarray) : (number_of_events,) each, "n/a" -> NaN
+    
+    """
+
+    delimiter = "," if events_name.endswith(".csv") else "\t"
+    # Every column is read as text, type inference breaks on "n/a" after numeric rows
+    with open(events_name, newline="") as events_file:
+        events = list(csv.DictReader(events_file, delimiter=delimiter))
+    if trial_type is not None:
+        events = [e for e in events if e["trial_type"] == trial_type]
+
+    # BIDS allows "n/a" for unknown values
+    onsets, durations = [np.array([np.nan if e[k].strip() in ("n/a", "") else float(e[k]) for e in events])
+                         for k in ("onset", "duration")]
+
+    return onsets, durations
+
+def epoch_timeseries(timeserie: np.ndarray, onsets: np.ndarray, window: float = None,
+                     durations: np.ndarray = None, TR: float = None, baseline_length: int = None) -> np.ndarray:
+    """
+    Function that cuts timeseries into one window per event, generalizing
+    reshape_timeseries_byepoch to jittered onsets. If the onsets are regularly spaced
+    the output is a read-only strided view of timeserie (no copy), otherwise the
+    windows are gathered in one vectorized indexing. Events whose window does not
+    fit in the timeserie are discarded.
+    
+    Args:
+        timeserie (np.ndarray) : (n_timepoints,) or (number_of_voxels x n_timepoints), 
+                                 e.g. the output of load_timecourses
+        onsets (np.ndarray) : onset of each event, in samples, or in [s] if TR is given
+        window (float) : length of the windows, same unit as onsets. 
+                         Default None -> longest of durations, NaN durations ignored
+        durations (np.ndarray) : duration of each event, same unit as onsets
+        TR (float) : repetition time [s], if given onsets, window and durations are in [s]
+        baseline_length (int) : if given, normalize each event with normalize_epoch
+    
+    Returns:
+        (np.ndarray) : (number_of_events x window) or 
+                       (number_of_voxels x number_of_events x window)
+    
+    """
+
+    if window is None:
+        if durations is None or np.all(np.isnan(durations)):
+            raise ValueError("Either window or (non n/a) durations must be given!")
+        window = np.nanmax(durations)
+    onsets = np.asarray(onsets, dtype=float)
+    onsets = onsets[~np.isnan(onsets)]
+    if TR is not None:
+        onsets, window = onsets / TR, window / TR
+    onsets, window = np.round(onsets).astype(int), int(np.round(window))
+
+    timeserie = np.asarray(timeserie)
+    n_timepoints = timeserie.shape[-1]
+    onsets = onsets[(onsets >= 0) & (onsets + window <= n_timepoints)]
+
+    steps = np.diff(onsets)
+    step = steps[0] if len(steps) else 1
+    if len(onsets) > 0 and step > 0 and np.all(steps == step):
+        # Regular onsets -> strided view starting at the first event
+        start = timeserie[..., onsets[0]:]
+        epochs = np.lib.stride_tricks.as_strided(
+            start, shape=start.shape[:-1] + (len(onsets), window),
+            strides=start.strides[:-1] + (step * start.strides[-1], start.strides[-1]), writeable=False)
+    else:
+        epochs = np.lib.stride_tricks.sliding_window_view(timeserie, window, axis=-1)[..., onsets, :]
+
+    if baseline_length is not None:
+        epochs = normalize_epoch(epochs, baseline_length)
+
+    return epochs
+
 def normalize_epoch(timeserie_by_epoch: np.ndarray, baseline_length: int=5) -> np.ndarray:
     """
     Function that normalizes the ADC timeserie groubed by epoch with
-    the last baseline_length values of each epoch.
+    the last baseline_length values of each epoch. Any leading dimensions are
+    accepted, e.g. the (number_of_voxels x number_of_events x window) output of 
+    epoch_timeseries. Read-only inputs (strided views) are not modified, a new
+    array is returned instead.
     
     Args:
         timeserie_by_epoch (np.ndarray) : timeserie, grouped by epoch 
@@ -141,9 +307,10 @@ def normalize_epoch(timeserie_by_epoch: np.ndarray, baseline_length: int=5) -> n
     
     """
 
-    for i in range(timeserie_by_epoch.shape[0]):
-        # Takes the last sample of an epoch to calculate the baseline  
-        baseline_adc = np.mean(timeserie_by_epoch[i,-baseline_length:])
-        timeserie_by_epoch[i,:] = timeserie_by_epoch[i,:]/baseline_adc
+    # Takes the last samples of each epoch to calculate the baseline
+    baseline_adc = np.mean(timeserie_by_epoch[..., -baseline_length:], axis=-1, keepdims=True)
+    if not timeserie_by_epoch.flags.writeable:
+        return timeserie_by_epoch / baseline_adc
+    timeserie_by_epoch[:] = timeserie_by_epoch / baseline_adc
 
-    return timeserie_by_epoch
\ No newline at end of file
+    return timeserie_by_epoch
@@ -0,0 +1,215 @@
+import os
+import tempfile
+import warnings
+import numpy as np
+import nibabel as nib
+
+# Package-wide memory budget in bytes, None -> use the memory currently available
+_memory_budget = None
+
+
+def available_memory() -> int:
+    """
+    Function that returns the memory currently available on the node
+
+    Returns:
+        (int, float): available memory [bytes], MemAvailable of /proc/meminfo if readable, else
+                      the free physical pages. float('inf') with a warning if neither can be read
+                      (e.g. macOS, Windows), so that everything is planned in memory
+
+    """
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):  # no os.sysconf on Windows, no SC_AVPHYS_PAGES on macOS
+        warnings.warn('The available memory cannot be read on this platform, everything is planned in memory. '
+                      'Use set_memory_budget to enable chunked execution')
+        return float('inf')
+
+
+def set_memory_budget(budget) -> None:
+    """
+    Function that sets the memory budget used by plan_memory for the whole package
+    Usage: allow 4 GiB per job
+        set_memory_budget(4 * 1024 ** 3) or set_memory_budget('4G')
+
+    Args:
+        budget (int, str, None): budget in bytes, a string with a K, M or G suffix (powers of
+                                 1024), or None to use the memory available at planning time
+
+    """
+
+    global _memory_budget
+    if isinstance(budget, str):
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        budget = budget.strip().upper().rstrip('B')
+        if budget[-1] in units:
+            budget = float(budget[:-1]) * units[budget[-1]]
+    _memory_budget = None if budget is None else int(budget)
+
+
+def get_memory_budget() -> int:
+    """
+    Function that returns the memory budget currently in use
+
+    Returns:
+        (int, float): budget [bytes], see available_memory if no budget was set
+
+    """
+
+    if _memory_budget is None:
+        return available_memory()
+    return _memory_budget
+
+
+def plan_memory(img, out_dtype=np.float64, n_copies: int = 1, chunk_axis: int = -1) -> dict:
+    """
+    Function that estimates from the header alone the peak memory needed to load an image and
+    chooses between in-memory and chunked execution
+    Usage: log the plan chosen for a run
+        plan = plan_memory('/path/to/adc.nii.gz')
+        print(plan['mode'], plan['peak'] / 1024 ** 3, 'GiB')
+
+    Args:
+        img (str, nib.nifti1.Nifti1Image): path to the image or image, the data is not read
+        out_dtype (np.dtype): dtype of the arrays materialised by the caller
+        n_copies (int): number of full-size out_dtype arrays alive at the same time
+        chunk_axis (int): axis along which the image is split in chunked mode. Default -1 -> time
+                          for 4D images
+
+    Returns:
+        (dict): 'shape', 'dtype', 'out_dtype', 'peak' estimated bytes of the in-memory path,
+                'budget' bytes, 'mode' ("memory" or "chunked"), 'chunk_axis', 'chunk_size'
+                the number of slices along chunk_axis per chunk and 'chunk_bytes' the estimated
+                bytes of one chunk. Warns if even a single slice exceeds the budget
+
+    """
+
+    if not isinstance(img, nib.spatialimages.SpatialImage):
+        img = nib.load(img)
+
+    shape = tuple(int(s) for s in img.shape)
+    dtype = np.dtype(img.get_data_dtype())
+    out_dtype = np.dtype(out_dtype)
+    n_values = int(np.prod(shape))
+    # Raw on-disk buffer plus the scaled/cast arrays
+    peak = n_values * (dtype.itemsize + n_copies * out_dtype.itemsize)
+    budget = get_memory_budget()
+
+    chunk_axis = chunk_axis % len(shape)
+    per_slice = max(peak // shape[chunk_axis], 1)
+    if peak <= budget:
+        mode, chunk_size = 'memory', shape[chunk_axis]
+    else:
+        # A chunk gets a quarter of the budget, the rest is left to the outputs of the caller
+        mode, chunk_size = 'chunked', int(min(max(budget // 4 // per_slice, 1), shape[chunk_axis]))
+        if per_slice > budget:
+            warnings.warn(f'A single slice along axis {chunk_axis} needs {per_slice / 1024 ** 2:.1f} MiB, '
+                          f'more than the memory budget of {budget / 1024 ** 2:.1f} MiB')
+
+    return {'shape': shape, 'dtype': dtype, 'out_dtype': out_dtype, 'peak': peak, 'budget': budget,
+            'mode': mode, 'chunk_axis': chunk_axis, 'chunk_size': chunk_size,
+            'chunk_bytes': chunk_size * per_slice}
+
+
+def iter_chunks(img, plan: dict, dtype=np.float64):
+    """
+    Generator that reads an image chunk by chunk along plan['chunk_axis'], through the nibabel
+    array proxy so that only one chunk is in memory at a time. The file is kept open for the
+    whole loop: without indexed_gzip a .nii.gz can only be read forward, so chunks along the
+    time axis (contiguous on disk) are read in a single pass, while chunks along a spatial axis
+    decompress the file again for every chunk
+
+    Args:
+        img (nib.nifti1.Nifti1Image): image to read
+        plan (dict): plan returned by plan_memory
+        dtype (np.dtype): dtype of the yielded chunks, scaling (scl_slope, scl_inter) applied
+
+    Yields:
+        (slice, np.ndarray): position of the chunk along chunk_axis and the chunk
+
+    """
+
+    dataobj = img.dataobj
+    if nib.is_proxy(dataobj) and img.get_filename() is not None:
+        dataobj = nib.load(img.get_filename(), keep_file_open=True).dataobj
+
+    axis, size = plan['chunk_axis'], plan['chunk_size']
+    try:
+        for start in range(0, plan['shape'][axis], size):
+            sl = slice(start, min(start + size, plan['shape'][axis]))
+            index = [slice(None)] * len(plan['shape'])
+            index[axis] = sl
+            yield sl, np.asarray(dataobj[tuple(index)], dtype=dtype)
+    finally:
+        del dataobj  # closes the file handle
+
+
+def allocate_output(shape: tuple, dtype, plan: dict) -> np.ndarray:
+    """
+    Function that allocates the full-size output of a chunked computation, in memory if it fits
+    in the budget next to one chunk, else as a memmap on a temporary file (the file is unlinked,
+    its space is released with the array, except on Windows where it is left in the temporary
+    directory)
+
+    Args:
+        shape (tuple): shape of the output
+        dtype (np.dtype): dtype of the output
+        plan (dict): plan returned by plan_memory
+
+    Returns:
+        (np.ndarray, np.memmap): uninitialized output
+
+    """
+
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes + plan['chunk_bytes'] <= plan['budget']:
+        return np.empty(shape, dtype=dtype)
+
+    warnings.warn(f'The {nbytes / 1024 ** 2:.1f} MiB output does not fit in the memory budget of '
+                  f'{plan["budget"] / 1024 ** 2:.1f} MiB, it is stored in a temporary file instead')
+    fd, tmp_name = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+    data = np.memmap(tmp_name, dtype=dtype, mode='w+', shape=shape)
+    try:
+        os.unlink(tmp_name)  # the mapping keeps the space until the array is released
+    except OSError:
+        pass  # Windows cannot unlink a mapped file, it stays in the temporary directory
+    return data
+
+
+def load_data(img, plan: dict = None) -> np.ndarray:
+    """
+    Function that loads the data of an image as float64 if it fits in the memory budget, else as
+    float32 read chunk by chunk so that no full float64 copy is ever materialised. If even the
+    float32 array does not fit, it is backed by a temporary file (see allocate_output)
+
+    Args:
+        img (str, nib.nifti1.Nifti1Image): path to the image or image
+        plan (dict): plan returned by plan_memory. Default None -> planned from the header
+
+    Returns:
+        (np.ndarray, np.memmap): data of the image
+
+    """
+
+    if not isinstance(img, nib.spatialimages.SpatialImage):
+        img = nib.load(img)
+    if plan is None:
+        plan = plan_memory(img)
+    if plan['mode'] == 'memory':
+        return img.get_fdata()
+
+    data = allocate_output(plan['shape'], np.float32, plan)
+    index = [slice(None)] * len(plan['shape'])
+    for sl, chunk in iter_chunks(img, plan, dtype=np.float32):
+        index[plan['chunk_axis']] = sl
+        data[tuple(index)] = chunk
+    return data
@@ -5,6 +5,8 @@ from matplotlib.patches import Rectangle
 from scipy.ndimage import zoom
 import imageio
 import nibabel as nib
+import warnings
+from pydfMRI.memory import load_data, plan_memory, iter_chunks, get_memory_budget
 
 
 def print_volume(data: np.ndarray, time: int = 15) -> None:
@@ -74,6 +76,34 @@ def plot_timeserie_byepoch(timeserie_by_epoch: np.ndarray, annotation_type: str)
     plt.show()
 
 
+def _load_4d_plane(img: nib.nifti1.Nifti1Image, axis: int, slice4d, crop: bool, plan: dict) -> np.ndarray:
+    """
+    Read from disk only the plane of a 4D image that mkgif animates, cropped as mkgif does.
+    Returns a 4D array with a singleton dimension along axis
+    """
+    shape = plan['shape']
+    keep = [np.ones(n, dtype=bool) for n in shape[:3]]
+    if crop:  # as in mkgif, only the last crop (along z) takes effect
+        zsum = np.zeros(shape[2])
+        for _, chunk in iter_chunks(img, plan, dtype=np.float32):
+            zsum += np.nansum(chunk, axis=(0, 1, 3))
+        keep[2] = zsum > 0
+
+    kept = np.flatnonzero(keep[axis])
+    position = kept[len(kept) // 2] if isinstance(slice4d, bool) else kept[slice4d]
+    plane_bytes = int(np.prod(shape)) // shape[axis] * 8
+    if plane_bytes > get_memory_budget():
+        warnings.warn(f'The animated plane needs {plane_bytes / 1024 ** 2:.1f} MiB, more than the memory budget')
+
+    index = [slice(None)] * 4
+    index[axis] = slice(position, position + 1)
+    plane = np.asarray(img.dataobj[tuple(index)], dtype=np.float64)
+    for ax in range(3):
+        if ax != axis:
+            plane = np.compress(keep[ax], plane, axis=ax)
+    return plane
+
+
 def mkgif(img, path=False, view=0, slice4d=False, rotate=False, rotaxes=(1, 2), flip=False, rewind=True,
           winsorize=[1, 98],
           timebar=True, crosshair=False, scale=2, cmap=False, crop=True, vol_wise_norm=False, fps=60, concat_along=1):
@@ -98,6 +128,8 @@ def mkgif(img, path=False, view=0, slice4d=False, rotate=False, rotaxes=(1, 2),
         vol_wise_norm: normalize image volume-wise, only if timeseries. [default=False]
         fps: int, gif frame per second. Max 60. [default=60]
         concat_along: concatenate multiple images along a specific axis, same rule of np.concatenate. [default=1]
+    Images larger than the memory budget (see pydfMRI.memory) are loaded as float32 by chunks, for
+    4D images only the animated plane is read.
     return
         file path as string
     todo: add plot all 3 views in one command
@@ -109,21 +141,34 @@ def mkgif(img, path=False, view=0, slice4d=False, rotate=False, rotaxes=(1, 2),
     else:
         imgsl = img
 
+    viewsstr = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+    views = {0: [0, 1, 2], 1: [2, 0, 1], 2: [1, 2, 0]}  # move first the dimension to slice for chosen view
+    if isinstance(view, str):
+        view = viewsstr[view]
+
     toconcat = []
     for img in imgsl:
-        if isinstance(img, str):
-            inputimg = img
-            img = nib.load(img).get_fdata()
-        elif isinstance(img, nib.nifti1.Nifti1Image):
-            inputimg = img.get_filename()
-            img = img.get_fdata()
+        crop_img, slice4d_img = crop, slice4d
+        if isinstance(img, (str, nib.nifti1.Nifti1Image)):
+            if isinstance(img, str):
+                inputimg = img
+                img = nib.load(img)
+            else:
+                inputimg = img.get_filename()
+            plan = plan_memory(img)
+            if plan['mode'] == 'chunked' and img.ndim == 4 and not (rotate and 0 in rotaxes):
+                # Only one plane per volume is animated, read just that one
+                img = _load_4d_plane(img, views[view].index(0), slice4d, crop, plan)
+                crop_img, slice4d_img = False, 0
+            else:
+                img = load_data(img, plan)
         elif isinstance(img, np.ndarray):
             if not path:
                 raise IsADirectoryError("ERROR: when using a ndarray you must specify an output filename")
             img = img
 
         # Crop air areas
-        if crop:
+        if crop_img:
             if img.ndim == 4:
                 xv, yv, zv = np.nansum(img, axis=(1, 2, 3)) > 0, \
                              np.nansum(img, axis=(0, 2, 3)) > 0, \
@@ -139,10 +184,6 @@ def mkgif(img, path=False, view=0, slice4d=False, rotate=False, rotaxes=(1, 2),
                     img[:, yv, :], \
                     img[:, :, zv]
 
-        viewsstr = {'sagittal': 0, 'coronal': 1, 'axial': 2}
-        views = {0: [0, 1, 2], 1: [2, 0, 1], 2: [1, 2, 0]}  # move first the dimension to slice for chosen view
-        if isinstance(view, str):
-            view = viewsstr[view]
         if img.ndim == 4:
             img = np.moveaxis(img, [0, 1, 2, 3], views[view] + [3])
         else:
@@ -153,10 +194,10 @@ def mkgif(img, path=False, view=0, slice4d=False, rotate=False, rotaxes=(1, 2),
 
         if img.ndim == 4:
             img = np.moveaxis(img, 3, 0)  # push 4th dim (time) first since imageio iterates the first
-            if isinstance(slice4d, bool):  # Then slice 2nd dimension to allow 3D animation
+            if isinstance(slice4d_img, bool):  # Then slice 2nd dimension to allow 3D animation
                 img = img[:, img.shape[1] // 2, :, :]
             else:
-                img = img[:, slice4d, :, :]
+                img = img[:, slice4d_img, :, :]
 
         # Winsorize and normalize intensities for plot
         Lpcl, Hpcl = np.nanpercentile(img, winsorize[0]), np.nanpercentile(img, winsorize[1])